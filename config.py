@@ -1,214 +1,333 @@
+import math
+import os
+import pickle
+import sys
+from functools import lru_cache
+
 from yacs.config import CfgNode as CN
-from numpy import pi
-
-# CfgNode has two methods: merge_from_file and merge_from_list
-_C = CN()
-
-# ------------------------------------------------------------------------
-# Training
-# ------------------------------------------------------------------------
-_C.TRAIN = CN()
-  # TODO: choose to not pass the domain attention modules
-_C.TRAIN.DOMAIN_ATTENTION_NAMES = ['space_attn', 'instance_attn', 'channel_attn']
-_C.TRAIN.DOMAIN_DISCRIMINATOR_NAMES= ['space_D', 'channel_D', 'instance_D']
-
-_C.TRAIN.LR_ENCODER= 1e-05
-_C.TRAIN.ENCODER_NAMES= ['encoder'] # set for a different learning rate
-
-_C.TRAIN.LR_DECODER= 1e-05
-_C.TRAIN.DECODER_NAMES= ['decoder']
-
-_C.TRAIN.LR_MULTI_LABEL_CLASSIFIER= 1e-05
-_C.TRAIN.MULTI_LABEL_CLASSIFIER_NAMES= ['multi_label_classifier']
-
-
-_C.TRAIN.LR = 2e-4
-_C.TRAIN.LR_BACKBONE_NAMES = ["backbone.0"]
-_C.TRAIN.LR_BACKBONE = 2e-5
-_C.TRAIN.LR_LINEAR_PROJ_NAMES = ['reference_points', 'sampling_offsets']
-_C.TRAIN.LR_LINEAR_PROJ_MULT = 0.1
-_C.TRAIN.BATCH_SIZE = 2
-_C.TRAIN.WEIGHT_DECAY = 1e-4
-_C.TRAIN.EPOCHS = 50
-_C.TRAIN.LR_DROP = 40
-_C.TRAIN.LR_DROP_EPOCHS = None
-_C.TRAIN.CLIP_MAX_NORM = 0.1 # gradient clipping max norm
-_C.TRAIN.SGD = False # AdamW is used when setting this false
-
-
-# ------------------------------------------------------------------------
-# Model
-# ------------------------------------------------------------------------
-_C.MODEL = CN()
-
-# Variants of Deformable DETR
-_C.MODEL.WITH_BOX_REFINE = False
-_C.MODEL.TWO_STAGE = False
-
-# Model parameters
-_C.MODEL.FROZEN_WEIGHTS = None # Path to the pretrained model. If set, only the mask head will be trained
-
-# * Backbone
-_C.MODEL.BACKBONE = 'resnet50' # Name of the convolutional backbone to use
-_C.MODEL.DILATION = False # If true, we replace stride with dilation in the last convolutional block (DC5)
-_C.MODEL.POSITION_EMBEDDING = 'sine' # ('sine', 'learned') Type of positional embedding to use on top of the image features
-_C.MODEL.POSITION_EMBEDDING_SCALE = 2 * pi # position / size * scale
-_C.MODEL.NUM_FEATURE_LEVELS = 4 # number of feature levels
-
-# * Transformer
-_C.MODEL.ENC_LAYERS = 6 # Number of encoding layers in the transformer
-_C.MODEL.DEC_LAYERS = 6 # Number of decoding layers in the transformer
-_C.MODEL.DIM_FEEDFORWARD = 1024 # Intermediate size of the feedforward layers in the transformer blocks
-_C.MODEL.HIDDEN_DIM = 256 # Size of the embeddings (dimension of the transformer)
-_C.MODEL.DROPOUT = 0.1 # Dropout applied in the transformer
-_C.MODEL.NHEADS = 8 # Number of attention heads inside the transformer's attentions
-_C.MODEL.NUM_QUERIES = 300 # Number of query slots
-_C.MODEL.DEC_N_POINTS = 4
-_C.MODEL.ENC_N_POINTS = 4
-
-# TODO: memory params
-_C.MODEL.MEMORY_SIZE = 10
-_C.MODEL.MEMORY_DIM = 512
-
-# * Segmentation
-_C.MODEL.MASKS = False # Train segmentation head if the flag is provided
-
-# * Domain Adaptation
-_C.MODEL.BACKBONE_ALIGN = False
-_C.MODEL.SPACE_ALIGN = False
-_C.MODEL.CHANNEL_ALIGN = False
-_C.MODEL.INSTANCE_ALIGN = False
-
-# TODO: category alignemnt
-_C.MODEL.CATEGORY_ALIGN = False
-_C.MODEL.ENCODER_CLASS_ALIGN = False
-
-_C.MODEL.PROTOTYPE_ALIGN = False
-# query or sequence
-_C.MODEL.LOCAL_PROTOTYPE_ALIGN = 'sequence'
-_C.MODEL.GLOBAL_PROTOTYPE_ALIGN = False
-_C.MODEL.MEMORY = False
-_C.MODEL.STAGE = 'pretrain'
-
-# TODO: triplet loss params
-_C.MODEL.TAU = 0.2
-_C.MODEL.GAMMA = 0.1
-_C.MODEL.MARGIN = 0.01
-_C.MODEL.CENTERS = 10
-
-
-# ------------------------------------------------------------------------
-# Loss
-# ------------------------------------------------------------------------
-_C.LOSS = CN()
-_C.LOSS.AUX_LOSS = True # auxiliary decoding losses (loss at each layer)
-
-# * Matcher
-_C.LOSS.SET_COST_CLASS = 2. # Class coefficient in the matching cost
-_C.LOSS.SET_COST_BBOX = 5. # L1 box coefficient in the matching cost
-_C.LOSS.SET_COST_GIOU = 2. # giou box coefficient in the matching cost
-
-# * Loss coefficients
-_C.LOSS.MASK_LOSS_COEF = 1.
-_C.LOSS.DICE_LOSS_COEF = 1.
-_C.LOSS.CLS_LOSS_COEF = 2.
-_C.LOSS.BBOX_LOSS_COEF = 5.
-_C.LOSS.GIOU_LOSS_COEF = 2.
-_C.LOSS.BACKBONE_LOSS_COEF = 0.1
-_C.LOSS.SPACE_QUERY_LOSS_COEF = 0.1
-_C.LOSS.CHANNEL_QUERY_LOSS_COEF = 0.1
-_C.LOSS.INSTANCE_QUERY_LOSS_COEF = 0.1
-_C.LOSS.CATEGORY_QUERY_LOSS_COEF = 0.1
-_C.LOSS.MARGIN = 1
-
-# TODO for current implem.
-_C.LOSS.INTER_CLASS_COEF = 0.1
-_C.LOSS.INTRA_CLASS_COEF = 1.
-_C.LOSS.CROSS_SCALE_INTER_CLASS_COEF = 0.1
-_C.LOSS.CROSS_SCALE_INTRA_CLASS_COEF = 1.0
-
-_C.LOSS.BG_LOSS_COEF = 0.1
-
-_C.LOSS.CATEGORY_TOKEN_LOSS_COEF = 1.
-
-# multi class
-_C.LOSS.MULTI_CLASS_COEF = 0.01
-
-# global
-_C.LOSS.PROTOTYPE_TOKENS_LOSS_COEF = 0.1
-
-# local
-_C.LOSS.LOCAL_DECODER_EMBED_COEF = 0.1
-# _C.LOSS.ACTIVATION_MAP_ALIGN_LOSS_COEF = 0.1
-_C.LOSS.PROTOTYPE_ALIGN_LOSS_COEF = 0.1
-_C.LOSS.CMT_CLS_JS = 1.
-_C.LOSS.FOCAL_ALPHA = 0.25
-_C.LOSS.DA_GAMMA = 0
-
-_C.LOSS.SOFT_TRIPLET_SRC_COEF = 0.1
-_C.LOSS.SOFT_TRIPLET_TGT_COEF = 0.1
-_C.LOSS.COSISTENCY_COEF = 0.1
-
-_C.LOSS.MULTI_LABEL_LOSS_COEF = 0.1
-_C.LOSS.LAMDA = 0.25
-_C.LOSS.AUG_LOSS_COEF = 1.
-_C.LOSS.EOS_COEF = 0.1
-
-# ------------------------------------------------------------------------
-# dataset parameters
-# ------------------------------------------------------------------------
-_C.DATASET = CN()
-_C.DATASET.DA_MODE = 'source_only' # ('source_only', 'uda', 'oracle')
-_C.DATASET.NUM_CLASSES = 9 # This should be set as max_class_id + 1
-_C.DATASET.DATASET_FILE = 'cityscapes_to_foggy_cityscapes'
-_C.DATASET.COCO_PATH = '../datasets'
-_C.DATASET.COCO_PANOPTIC_PATH = None
-_C.DATASET.REMOVE_DIFFICULT = False
-
-
-# ------------------------------------------------------------------------
-# Distributed
-# ------------------------------------------------------------------------
-_C.DIST = CN()
-_C.DIST.DISTRIBUTED = False
-_C.DIST.RANK = None
-_C.DIST.WORLD_SIZE = None
-_C.DIST.GPU = None
-_C.DIST.DIST_URL = None
-_C.DIST.DIST_BACKEND = None
-
-
-# ------------------------------------------------------------------------
-# Miscellaneous
-# ------------------------------------------------------------------------
-_C.OUTPUT_DIR = '' # path where to save, empty for no saving
-_C.DEVICE = 'cuda' # device to use for training / testing
-_C.SEED = 42
-_C.RESUME = '' # resume from checkpoint
-_C.RESUME_MEMORY = '' # resume memory items from checkpoint
-_C.START_EPOCH = 0 # start epoch
-_C.EVAL = False
-_C.NUM_WORKERS = 2
-_C.CACHE_MODE = False # whether to cache images on memory
-
-# debug mode
-_C.DEBUG = False
-_C.CHECK_BOXES = False
-_C.PLOT_MODE = 'all'
-_C.CAM_VIZ = False
-_C.ACCUMULATE_STATS = False
-
-# exp
-_C.FINETUNE = False
-_C.EMA = False
-_C.FEAT_AUG = False
-_C.CONTRASTIVE = False
-
-
-
-
-def get_cfg_defaults():
-  """Get a yacs CfgNode object with default values for my_project."""
+
+# Shared default values: learning rate of the separately tuned encoder /
+# decoder / classifier groups and the common loss coefficients
+_LR_MIN = 1e-05
+_COEF_SMALL = 0.1
+_COEF_ONE = 1.
+
+# Pickled copy of the defaults, rebuilt whenever this file is newer than it
+_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config_defaults.pkl')
+
+
+def _build_defaults():
+  # ------------------------------------------------------------------------
+  # Training
+  # ------------------------------------------------------------------------
+  train = {
+    # TODO: choose to not pass the domain attention modules
+    'DOMAIN_ATTENTION_NAMES': ('space_attn', 'instance_attn', 'channel_attn'),
+    'DOMAIN_DISCRIMINATOR_NAMES': ('space_D', 'channel_D', 'instance_D'),
+
+    'LR_ENCODER': _LR_MIN,
+    'ENCODER_NAMES': ('encoder',), # set for a different learning rate
+
+    'LR_DECODER': _LR_MIN,
+    'DECODER_NAMES': ('decoder',),
+
+    'LR_MULTI_LABEL_CLASSIFIER': _LR_MIN,
+    'MULTI_LABEL_CLASSIFIER_NAMES': ('multi_label_classifier',),
+
+
+    'LR': 2e-4,
+    'LR_BACKBONE_NAMES': ("backbone.0",),
+    'LR_BACKBONE': 2e-5,
+    'LR_LINEAR_PROJ_NAMES': ('reference_points', 'sampling_offsets'),
+    'LR_LINEAR_PROJ_MULT': 0.1,
+    'BATCH_SIZE': 2,
+    'WEIGHT_DECAY': 1e-4,
+    'EPOCHS': 50,
+    'LR_DROP': 40,
+    'LR_DROP_EPOCHS': None,
+    'CLIP_MAX_NORM': 0.1, # gradient clipping max norm
+    'SGD': False, # AdamW is used when setting this false
+  }
+
+
+  # ------------------------------------------------------------------------
+  # Model
+  # ------------------------------------------------------------------------
+  model = {
+    # Variants of Deformable DETR
+    'WITH_BOX_REFINE': False,
+    'TWO_STAGE': False,
+    'COMPILE': False, # torch.compile the feature-level extension, MLP heads and post-processing box conversion
+
+    # Model parameters
+    'FROZEN_WEIGHTS': None, # Path to the pretrained model. If set, only the mask head will be trained
+
+    # * Backbone
+    'BACKBONE': 'resnet50', # Name of the convolutional backbone to use
+    'DILATION': False, # If true, we replace stride with dilation in the last convolutional block (DC5)
+    'POSITION_EMBEDDING': 'sine', # ('sine', 'learned') Type of positional embedding to use on top of the image features
+    'POSITION_EMBEDDING_SCALE': 2 * math.pi, # position / size * scale
+    'NUM_FEATURE_LEVELS': 4, # number of feature levels
+
+    # * Transformer
+    'ENC_LAYERS': 6, # Number of encoding layers in the transformer
+    'DEC_LAYERS': 6, # Number of decoding layers in the transformer
+    'DIM_FEEDFORWARD': 1024, # Intermediate size of the feedforward layers in the transformer blocks
+    'HIDDEN_DIM': 256, # Size of the embeddings (dimension of the transformer)
+    'DROPOUT': 0.1, # Dropout applied in the transformer
+    'NHEADS': 8, # Number of attention heads inside the transformer's attentions
+    'NUM_QUERIES': 300, # Number of query slots
+    'DEC_N_POINTS': 4,
+    'ENC_N_POINTS': 4,
+
+    # TODO: memory params
+    'MEMORY_SIZE': 10,
+    'MEMORY_DIM': 512,
+
+    # * Segmentation
+    'MASKS': False, # Train segmentation head if the flag is provided
+
+    # * Domain Adaptation
+    'BACKBONE_ALIGN': False,
+    'SPACE_ALIGN': False,
+    'CHANNEL_ALIGN': False,
+    'INSTANCE_ALIGN': False,
+
+    # TODO: category alignemnt
+    'CATEGORY_ALIGN': False,
+    'ENCODER_CLASS_ALIGN': False,
+
+    'PROTOTYPE_ALIGN': False,
+    # query or sequence
+    'LOCAL_PROTOTYPE_ALIGN': 'sequence',
+    'GLOBAL_PROTOTYPE_ALIGN': False,
+    'MEMORY': False,
+    'STAGE': 'pretrain',
+
+    # TODO: triplet loss params
+    'TAU': 0.2,
+    'GAMMA': 0.1,
+    'MARGIN': 0.01,
+    'CENTERS': 10,
+  }
+
+
+  # ------------------------------------------------------------------------
+  # Loss
+  # ------------------------------------------------------------------------
+  loss = {
+    'AUX_LOSS': True, # auxiliary decoding losses (loss at each layer)
+
+    # * Matcher
+    'SET_COST_CLASS': 2., # Class coefficient in the matching cost
+    'SET_COST_BBOX': 5., # L1 box coefficient in the matching cost
+    'SET_COST_GIOU': 2., # giou box coefficient in the matching cost
+
+    # * Loss coefficients
+    'MASK_LOSS_COEF': _COEF_ONE,
+    'DICE_LOSS_COEF': _COEF_ONE,
+    'CLS_LOSS_COEF': 2.,
+    'BBOX_LOSS_COEF': 5.,
+    'GIOU_LOSS_COEF': 2.,
+    'BACKBONE_LOSS_COEF': _COEF_SMALL,
+    'SPACE_QUERY_LOSS_COEF': _COEF_SMALL,
+    'CHANNEL_QUERY_LOSS_COEF': _COEF_SMALL,
+    'INSTANCE_QUERY_LOSS_COEF': _COEF_SMALL,
+    'CATEGORY_QUERY_LOSS_COEF': _COEF_SMALL,
+    'MARGIN': 1,
+
+    # TODO for current implem.
+    'INTER_CLASS_COEF': _COEF_SMALL,
+    'INTRA_CLASS_COEF': _COEF_ONE,
+    'CROSS_SCALE_INTER_CLASS_COEF': _COEF_SMALL,
+    'CROSS_SCALE_INTRA_CLASS_COEF': _COEF_ONE,
+
+    'BG_LOSS_COEF': _COEF_SMALL,
+
+    'CATEGORY_TOKEN_LOSS_COEF': _COEF_ONE,
+
+    # multi class
+    'MULTI_CLASS_COEF': 0.01,
+
+    # global
+    'PROTOTYPE_TOKENS_LOSS_COEF': _COEF_SMALL,
+
+    # local
+    'LOCAL_DECODER_EMBED_COEF': _COEF_SMALL,
+    # 'ACTIVATION_MAP_ALIGN_LOSS_COEF': 0.1,
+    'PROTOTYPE_ALIGN_LOSS_COEF': _COEF_SMALL,
+    'CMT_CLS_JS': _COEF_ONE,
+    'FOCAL_ALPHA': 0.25,
+    'DA_GAMMA': 0,
+
+    'SOFT_TRIPLET_SRC_COEF': _COEF_SMALL,
+    'SOFT_TRIPLET_TGT_COEF': _COEF_SMALL,
+    'COSISTENCY_COEF': _COEF_SMALL,
+
+    'MULTI_LABEL_LOSS_COEF': _COEF_SMALL,
+    'LAMDA': 0.25,
+    'AUG_LOSS_COEF': _COEF_ONE,
+    'EOS_COEF': _COEF_SMALL,
+  }
+
+  # ------------------------------------------------------------------------
+  # dataset parameters
+  # ------------------------------------------------------------------------
+  dataset = {
+    'DA_MODE': 'source_only', # ('source_only', 'uda', 'oracle')
+    'NUM_CLASSES': 9, # This should be set as max_class_id + 1
+    'DATASET_FILE': 'cityscapes_to_foggy_cityscapes',
+    'COCO_PATH': '../datasets',
+    'COCO_PANOPTIC_PATH': None,
+    'REMOVE_DIFFICULT': False,
+  }
+
+
+  # ------------------------------------------------------------------------
+  # Distributed
+  # ------------------------------------------------------------------------
+  dist = {
+    'DISTRIBUTED': False,
+    'RANK': None,
+    'WORLD_SIZE': None,
+    'GPU': None,
+    'DIST_URL': None,
+    'DIST_BACKEND': None,
+  }
+
+  # CfgNode has two methods: merge_from_file and merge_from_list
+  return CN({
+    'TRAIN': train,
+    'MODEL': model,
+    'LOSS': loss,
+    'DATASET': dataset,
+    'DIST': dist,
+
+    # ------------------------------------------------------------------------
+    # Miscellaneous
+    # ------------------------------------------------------------------------
+    'OUTPUT_DIR': '', # path where to save, empty for no saving
+    'DEVICE': 'cuda', # device to use for training / testing
+    'SEED': 42,
+    'RESUME': '', # resume from checkpoint
+    'RESUME_MEMORY': '', # resume memory items from checkpoint
+    'START_EPOCH': 0, # start epoch
+    'EVAL': False,
+    'EVAL_CUDA_GRAPH': False, # replay the bbox post-processing from CUDA graphs during evaluation
+    'NUM_WORKERS': 2,
+    'CACHE_MODE': False, # whether to cache images on memory
+
+    # debug mode
+    'DEBUG': False,
+    'CHECK_BOXES': False,
+    'PLOT_MODE': 'all',
+    'CAM_VIZ': False,
+    'ACCUMULATE_STATS': False,
+
+    # exp
+    'FINETUNE': False,
+    'EMA': False,
+    'FEAT_AUG': False,
+    'CONTRASTIVE': False,
+  })
+
+
+def _load_defaults():
+  """Load the defaults from the pickle cache, rebuilding it if missing or stale."""
+  try:
+    if os.path.getmtime(_CACHE_FILE) >= os.path.getmtime(__file__):
+      with open(_CACHE_FILE, 'rb') as f:
+        return pickle.load(f)
+  except Exception:
+    # missing, stale-format or otherwise unreadable cache (other Python or yacs version), rebuild it
+    pass
+
+  cfg = _build_defaults()
+  try:
+    tmp_file = f'{_CACHE_FILE}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+      pickle.dump(cfg, f, protocol=pickle.DEFAULT_PROTOCOL)
+    os.replace(tmp_file, _CACHE_FILE)
+  except OSError:
+    # read-only checkout, just use the freshly built defaults
+    pass
+  return cfg
+
+
+def intern_strings(cfg):
+  """Intern the string values of cfg in place so that comparisons like
+  cfg.MODEL.STAGE == 'pretrain' hit the identity fast path.
+
+  Strings coming from pickle.load or a YAML merge are fresh objects, unlike
+  the literals they are compared against. Call this before cfg.freeze().
+  """
+  for k, v in cfg.items():
+    if isinstance(v, CN):
+      intern_strings(v)
+    elif isinstance(v, str):
+      cfg[k] = sys.intern(v)
+    elif isinstance(v, (list, tuple)):
+      cfg[k] = type(v)(sys.intern(x) if isinstance(x, str) else x for x in v)
+  return cfg
+
+
+_C = intern_strings(_load_defaults())
+# The shared defaults are never written after import; forked workers keep
+# sharing their pages and accidental writes raise instead of leaking
+_C.freeze()
+
+
+def get_cfg_defaults(unsafe=False):
+  """Get a yacs CfgNode object with default values for my_project.
+
+  With unsafe=True the shared, frozen defaults are returned without the
+  deepcopy done by clone().
+  """
+  if unsafe:
+    return _C
   # Return a clone so that the defaults will not be altered
   # This is for the "local variable" use pattern
-  return _C.clone()
+  cfg = _C.clone()
+  # clone() carries over the immutable flag of the frozen _C
+  cfg.defrost()
+  return cfg
+
+
+def get_cfg_defaults_readonly():
+  """Get the shared default CfgNode, which is frozen at import."""
+  return _C
+
+
+def _merge_cfg(path, overrides):
+  cfg = get_cfg_defaults()
+  if path:
+    cfg.merge_from_file(path)
+  if overrides:
+    cfg.merge_from_list(list(overrides))
+  return intern_strings(cfg)
+
+
+@lru_cache(maxsize=32)
+def _load_cfg_from_file(path, mtime_ns, overrides):
+  # mtime_ns is only part of the cache key, so that editing the file reloads it
+  cfg = _merge_cfg(path, overrides)
+  cfg.freeze()
+  return cfg
+
+
+def get_cfg_from_file(path, overrides=(), freeze=True):
+  """Get the defaults merged with the YAML file at path and a flat list of
+  KEY VALUE overrides, cloning the defaults only once.
+
+  Frozen results are cached by (path, mtime, overrides) and shared between
+  callers. Pass freeze=False to get a private mutable copy when the caller
+  still has to fill in values, e.g. DIST.* in util.misc.init_distributed_mode;
+  that path bypasses the cache.
+  """
+  if not freeze:
+    return _merge_cfg(path, overrides)
+  mtime_ns = None
+  if path:
+    path = os.path.abspath(path)
+    mtime_ns = os.stat(path).st_mtime_ns
+  return _load_cfg_from_file(path, mtime_ns, tuple(overrides))
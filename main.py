@@ -15,6 +15,7 @@ import argparse
 import datetime
 import json
 import random
+import re
 import time
 from pathlib import Path
 
@@ -28,15 +29,12 @@ import datasets.samplers as samplers
 from datasets import build_dataset, get_coco_api_from_dataset
 from engine import evaluate, train_one_epoch, check_boxes
 from models import build_model
-from config import get_cfg_defaults
+from config import get_cfg_from_file, intern_strings
 
 def setup(args):
-    cfg = get_cfg_defaults()
-    if args.config_file:
-        cfg.merge_from_file(args.config_file)
-    if args.opts:
-        cfg.merge_from_list(args.opts)
+    cfg = get_cfg_from_file(args.config_file, args.opts or (), freeze=False)
     utils.init_distributed_mode(cfg)
+    intern_strings(cfg)
     cfg.freeze()
 
     if cfg.OUTPUT_DIR:
@@ -137,6 +135,15 @@ def main(cfg):
                 break
         return out
 
+    def compile_name_keywords(name_keywords):
+        # a single regex alternation does the substring test for all keywords at once
+        if not name_keywords:
+            return re.compile(r'(?!)') # never matches, like an empty keyword list
+        return re.compile('|'.join(map(re.escape, name_keywords)))
+
+    lr_backbone_names_re = compile_name_keywords(cfg.TRAIN.LR_BACKBONE_NAMES)
+    lr_linear_proj_names_re = compile_name_keywords(cfg.TRAIN.LR_LINEAR_PROJ_NAMES)
+
     for n, p in model_without_ddp.named_parameters():
         print(n)
 
@@ -145,15 +152,15 @@ def main(cfg):
             {
                 "params":
                     [p for n, p in model_without_ddp.named_parameters()
-                    if not match_name_keywords(n, cfg.TRAIN.LR_BACKBONE_NAMES) and not match_name_keywords(n, cfg.TRAIN.LR_LINEAR_PROJ_NAMES) and p.requires_grad],
+                    if not lr_backbone_names_re.search(n) and not lr_linear_proj_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR,
             },
             {
-                "params": [p for n, p in model_without_ddp.named_parameters() if match_name_keywords(n, cfg.TRAIN.LR_BACKBONE_NAMES) and p.requires_grad],
+                "params": [p for n, p in model_without_ddp.named_parameters() if lr_backbone_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR_BACKBONE,
             },
             {
-                "params": [p for n, p in model_without_ddp.named_parameters() if match_name_keywords(n, cfg.TRAIN.LR_LINEAR_PROJ_NAMES) and p.requires_grad],
+                "params": [p for n, p in model_without_ddp.named_parameters() if lr_linear_proj_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR * cfg.TRAIN.LR_LINEAR_PROJ_MULT,
             }
         ]
@@ -217,15 +224,15 @@ def main(cfg):
             {
                 "params":
                     [p for n, p in model_without_ddp.named_parameters()
-                    if not match_name_keywords(n, cfg.TRAIN.LR_BACKBONE_NAMES) and not match_name_keywords(n, cfg.TRAIN.LR_LINEAR_PROJ_NAMES) and p.requires_grad],
+                    if not lr_backbone_names_re.search(n) and not lr_linear_proj_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR,
             },
             {
-                "params": [p for n, p in model_without_ddp.named_parameters() if match_name_keywords(n, cfg.TRAIN.LR_BACKBONE_NAMES) and p.requires_grad],
+                "params": [p for n, p in model_without_ddp.named_parameters() if lr_backbone_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR_BACKBONE,
             },
             {
-                "params": [p for n, p in model_without_ddp.named_parameters() if match_name_keywords(n, cfg.TRAIN.LR_LINEAR_PROJ_NAMES) and p.requires_grad],
+                "params": [p for n, p in model_without_ddp.named_parameters() if lr_linear_proj_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR * cfg.TRAIN.LR_LINEAR_PROJ_MULT,
             }
         ]
@@ -248,15 +255,15 @@ def main(cfg):
             {
                 "params":
                     [p for n, p in model_without_ddp.named_parameters()
-                    if not match_name_keywords(n, cfg.TRAIN.LR_BACKBONE_NAMES) and not match_name_keywords(n, cfg.TRAIN.LR_LINEAR_PROJ_NAMES) and p.requires_grad],
+                    if not lr_backbone_names_re.search(n) and not lr_linear_proj_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR,
             },
             {
-                "params": [p for n, p in model_without_ddp.named_parameters() if match_name_keywords(n, cfg.TRAIN.LR_BACKBONE_NAMES) and p.requires_grad],
+                "params": [p for n, p in model_without_ddp.named_parameters() if lr_backbone_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR_BACKBONE,
             },
             {
-                "params": [p for n, p in model_without_ddp.named_parameters() if match_name_keywords(n, cfg.TRAIN.LR_LINEAR_PROJ_NAMES) and p.requires_grad],
+                "params": [p for n, p in model_without_ddp.named_parameters() if lr_linear_proj_names_re.search(n) and p.requires_grad],
                 "lr": cfg.TRAIN.LR * cfg.TRAIN.LR_LINEAR_PROJ_MULT,
             }
         ]
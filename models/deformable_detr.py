@@ -29,6 +29,7 @@ from .segmentation import (DETRsegm, PostProcessPanoptic, PostProcessSegm,
 from .deformable_transformer import build_deforamble_transformer
 from .utils import GradientReversal
 import copy
+from functools import lru_cache
 
 
 def _get_clones(module, N):
@@ -97,6 +98,8 @@ class DeformableDETR(nn.Module):
         self.channel_align = channel_align
         self.instance_align = instance_align
         self.debug = debug
+        # side CUDA streams for the per-level input projections, created on first CUDA forward
+        self._proj_streams = None
 
         prior_prob = 0.01
         bias_value = -math.log((1 - prior_prob) / prior_prob)
@@ -165,8 +168,8 @@ class DeformableDETR(nn.Module):
                                (center_x, center_y, height, width). These values are normalized in [0, 1],
                                relative to the size of each individual image (disregarding possible padding).
                                See PostProcess for information on how to retrieve the unnormalized bounding box.
-               - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a list of
-                                dictionnaries containing the two above keys for each decoder layer.
+               - "aux_outputs": Optional, only returned when auxilary losses are activated. It is a dictionnary
+                                containing the two above keys, stacked over the intermediate decoder layers.
         """
         if not isinstance(samples, NestedTensor):
             samples = nested_tensor_from_tensor_list(samples)
@@ -180,28 +183,17 @@ class DeformableDETR(nn.Module):
         masks = []
 
         # different layer features
-        for l, feat in enumerate(features):
-            src, mask = feat.decompose()
-            srcs.append(self.input_proj[l](src))
-            masks.append(mask)
-            assert mask is not None
+        if features[0].tensors.is_cuda:
+            srcs, masks = self._input_proj_on_streams(features)
+        else:
+            for l, feat in enumerate(features):
+                src, mask = feat.decompose()
+                srcs.append(self.input_proj[l](src))
+                masks.append(mask)
+                assert mask is not None
         
         if self.num_feature_levels > len(srcs):
-            _len_srcs = len(srcs)
-            # num_feature_levels = 4 by defualt
-            for l in range(_len_srcs, self.num_feature_levels):
-
-                # one feature level
-                if l == _len_srcs:
-                    src = self.input_proj[l](features[-1].tensors)
-                else:
-                    src = self.input_proj[l](srcs[-1])
-                m = samples.mask
-                mask = F.interpolate(m[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
-                pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
-                srcs.append(src)
-                masks.append(mask)
-                pos.append(pos_l)
+            srcs, masks, pos = self._extend_levels(srcs, masks, pos, samples.mask, features[-1].tensors)
 
         query_embeds = None
         if not self.two_stage:
@@ -215,24 +207,17 @@ class DeformableDETR(nn.Module):
             hs, init_reference, inter_references, enc_outputs_class, enc_outputs_coord_unact, da_output = self.transformer(srcs, masks, pos, query_embeds)
             
         # import pdb; pdb.set_trace()
-        outputs_classes = []
-        outputs_coords = []
+        # reference points of every decoder layer, unsigmoided in one go
+        references = torch.cat([init_reference[None], inter_references[:hs.shape[0] - 1]], dim=0)
+        references = inverse_sigmoid(references)
 
-        # multi level outputs
-        for lvl in range(hs.shape[0]):
-            if lvl == 0:
-                reference = init_reference
-            else:
-                reference = inter_references[lvl - 1]
-            reference = inverse_sigmoid(reference)
-
-            # final predictions
-            outputs_class = self.class_embed[lvl](hs[lvl]) # linear layer
-
-            # import pdb; pdb.set_trace()
-
-            tmp = self.bbox_embed[lvl](hs[lvl]) # mlp layer
+        if not self.with_box_refine:
+            # class_embed / bbox_embed hold the same module for every decoder layer, so run them
+            # once over all layers (hs is (num_layers, B, Q, C) and Linear broadcasts over it)
+            reference = references
 
+            outputs_class = self.class_embed[0](hs) # linear layer
+            tmp = self.bbox_embed[0](hs) # mlp layer
 
             if reference.shape[-1] == 4:
                 # deformable-detr predicts relative coordinates, unlike detr, which predicts absolute coordinates
@@ -242,11 +227,36 @@ class DeformableDETR(nn.Module):
                 tmp[..., :2] += reference
 
             outputs_coord = tmp.sigmoid()
-            outputs_classes.append(outputs_class)
-            outputs_coords.append(outputs_coord)
 
-        outputs_class = torch.stack(outputs_classes)
-        outputs_coord = torch.stack(outputs_coords)
+        else:
+            outputs_classes = []
+            outputs_coords = []
+
+            # multi level outputs
+            for lvl in range(hs.shape[0]):
+                reference = references[lvl]
+
+                # final predictions
+                outputs_class = self.class_embed[lvl](hs[lvl]) # linear layer
+
+                # import pdb; pdb.set_trace()
+
+                tmp = self.bbox_embed[lvl](hs[lvl]) # mlp layer
+
+
+                if reference.shape[-1] == 4:
+                    # deformable-detr predicts relative coordinates, unlike detr, which predicts absolute coordinates
+                    tmp += reference
+                else:
+                    assert reference.shape[-1] == 2
+                    tmp[..., :2] += reference
+
+                outputs_coord = tmp.sigmoid()
+                outputs_classes.append(outputs_class)
+                outputs_coords.append(outputs_coord)
+
+            outputs_class = torch.stack(outputs_classes)
+            outputs_coord = torch.stack(outputs_coords)
 
         # import pdb; pdb.set_trace()
 
@@ -264,18 +274,26 @@ class DeformableDETR(nn.Module):
                 enc_outputs_coord_unact = enc_outputs_coord_unact[:B//2]
 
             # discriminator outputs
-            # backbone here is an MLP for discriminator
-            if self.backbone_align:
-                da_output['backbone'] = torch.cat([self.backbone_D(self.grl(src.flatten(2).transpose(1, 2))) for src in srcs], dim=1)
-            if self.space_align:
-                # (2, 1, 256)
-                # (2, 1, 6) --> 6 outputs
-                da_output['space_query'] = self.space_D(da_output['space_query'])
-
-            if self.channel_align:
-                da_output['channel_query'] = self.channel_D(da_output['channel_query'])
-            if self.instance_align:
-                da_output['instance_query'] = self.instance_D(da_output['instance_query'])
+            # the discriminators are small MLPs, run them in bf16 on GPUs with native bf16 (Ampere and newer,
+            # older ones only emulate it) and hand fp32 logits to the losses
+            use_bf16 = hs.is_cuda and torch.cuda.get_device_capability(hs.device)[0] >= 8
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=use_bf16):
+                # backbone here is an MLP for discriminator
+                if self.backbone_align:
+                    # the discriminator is shared across levels, so run it once over the concatenated tokens
+                    src_flatten = torch.cat([src.flatten(2).transpose(1, 2) for src in srcs], dim=1)
+                    da_output['backbone'] = self.backbone_D(self.grl(src_flatten))
+                if self.space_align:
+                    # (2, 1, 256)
+                    # (2, 1, 6) --> 6 outputs
+                    da_output['space_query'] = self.space_D(da_output['space_query'])
+
+                if self.channel_align:
+                    da_output['channel_query'] = self.channel_D(da_output['channel_query'])
+                if self.instance_align:
+                    da_output['instance_query'] = self.instance_D(da_output['instance_query'])
+            if use_bf16:
+                da_output = {k: v.float() for k, v in da_output.items()}
 
         # TODO source only training doesn't care bout splitting batch
         elif self.training and self.uda and self.da_mode == 'source_only':
@@ -301,7 +319,7 @@ class DeformableDETR(nn.Module):
             out['da_output'] = da_output
 
         if self.accumulate:
-            out['probs'] = F.softmax(outputs_class[-1])
+            out['probs'] = outputs_class[-1].softmax(-1)
 
         if self.debug:
             # import pdb; pdb.set_trace()
@@ -309,6 +327,54 @@ class DeformableDETR(nn.Module):
         else:
             return out
 
+    def _extend_levels(self, srcs, masks, pos, samples_mask, last_feature):
+        """ Adds the feature levels beyond the backbone outputs (strided 3x3 conv + GroupNorm),
+            with their masks and positional encodings. Returns new lists.
+        """
+        srcs, masks, pos = list(srcs), list(masks), list(pos)
+        _len_srcs = len(srcs)
+        # num_feature_levels = 4 by defualt
+        for l in range(_len_srcs, self.num_feature_levels):
+
+            # one feature level
+            if l == _len_srcs:
+                src = self.input_proj[l](last_feature)
+            else:
+                src = self.input_proj[l](srcs[-1])
+            mask = F.interpolate(samples_mask[None].float(), size=src.shape[-2:]).to(torch.bool)[0]
+            pos_l = self.backbone[1](NestedTensor(src, mask)).to(src.dtype)
+            srcs.append(src)
+            masks.append(mask)
+            pos.append(pos_l)
+        return srcs, masks, pos
+
+    def _input_proj_on_streams(self, features):
+        """ Runs the independent per-level 1x1 conv + GroupNorm projections on their own CUDA
+            streams so the small kernels overlap, then joins them back into the current stream.
+        """
+        device = features[0].tensors.device
+        if self._proj_streams is None or self._proj_streams[0].device != device:
+            self._proj_streams = [torch.cuda.Stream(device=device) for _ in range(len(self.input_proj))]
+
+        current_stream = torch.cuda.current_stream(device)
+        srcs = []
+        masks = []
+        for l, feat in enumerate(features):
+            src, mask = feat.decompose()
+            stream = self._proj_streams[l]
+            # the backbone features are produced on the current stream
+            stream.wait_stream(current_stream)
+            with torch.cuda.stream(stream):
+                srcs.append(self.input_proj[l](src))
+            masks.append(mask)
+            assert mask is not None
+
+        for l, src in enumerate(srcs):
+            current_stream.wait_stream(self._proj_streams[l])
+            # keep the caching allocator from reusing the memory while the current stream still reads it
+            src.record_stream(current_stream)
+        return srcs, masks
+
     def compute_category_codes(self, source_samples, source_targets):
         num_supp = source_samples.tensors.shape[0]
 
@@ -337,13 +403,14 @@ class DeformableDETR(nn.Module):
             boxes = [box_ops.box_cxcywh_to_xyxy(t['boxes']) for t in source_targets]
             # and from relative [0, 1] to absolute [0, height] coordinates
             img_sizes = torch.stack([t["size"] for t in source_targets], dim=0)
-            img_h, img_w = img_sizes.unbind(1)
-            scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
+            scale_fct = img_sizes[:, [1, 0, 1, 0]] # (w, h, w, h)
             # import pdb; pdb.set_trace()
 
-            for b in range(num_supp):
-                boxes[b] *= scale_fct[b]
-                # import pdb; pdb.set_trace()
+            # scale the boxes of all support images with one multiply instead of one kernel per image
+            num_boxes = [len(b) for b in boxes]
+            scale_fct = scale_fct.repeat_interleave(torch.as_tensor(num_boxes, device=scale_fct.device),
+                                                    dim=0, output_size=sum(num_boxes))
+            boxes = list((torch.cat(boxes, dim=0) * scale_fct).split(num_boxes))
 
             query_embeds = self.query_embed.to(src.device)
 
@@ -394,11 +461,9 @@ class DeformableDETR(nn.Module):
 
     @torch.jit.unused
     def _set_aux_loss(self, outputs_class, outputs_coord):
-        # this is a workaround to make torchscript happy, as torchscript
-        # doesn't support dictionary with non-homogeneous values, such
-        # as a dict having both a Tensor and a list.
-        return [{'pred_logits': a, 'pred_boxes': b}
-                for a, b in zip(outputs_class[:-1], outputs_coord[:-1])]
+        # outputs of the intermediate decoder layers, kept stacked along the first dim;
+        # SetCriterion indexes them one layer at a time
+        return {'pred_logits': outputs_class[:-1], 'pred_boxes': outputs_coord[:-1]}
 
 
 class SetCriterion(nn.Module):
@@ -424,6 +489,9 @@ class SetCriterion(nn.Module):
         self.focal_alpha = focal_alpha
         self.da_gamma = da_gamma
         self.return_indices = return_indices
+        # (indices, permutation idx) of the last matcher result, shared by all losses computed from it
+        self._src_idx_cache = None
+        self._tgt_idx_cache = None
 
     def loss_labels(self, outputs, targets, indices, num_boxes, log=True):
         """Classification loss (NLL)
@@ -443,22 +511,15 @@ class SetCriterion(nn.Module):
         # TODO for single class, need to convert target_classes_o to ones since the target_classes_o
         # elements will be used for scattering the one hot vectors later on
         # target_classes_o = torch.ones_like(target_classes_o)
-        
-        target_classes = torch.full(src_logits.shape[:2], self.num_classes,
-                                    dtype=torch.int64, device=src_logits.device) # (1, 300)
-
-        # idx stores batch indx and query index
-        target_classes[idx] = target_classes_o # become ones
 
-        # (1, 300, 10)
-        target_classes_onehot = torch.zeros([src_logits.shape[0], src_logits.shape[1], src_logits.shape[2] + 1],
-                                            dtype=src_logits.dtype, layout=src_logits.layout, device=src_logits.device)
+        # (1, 300, 9), unmatched queries (no-object) stay all zeros
+        target_classes_onehot = torch.zeros(src_logits.shape, dtype=src_logits.dtype,
+                                            layout=src_logits.layout, device=src_logits.device)
 
-        
-        target_classes_onehot.scatter_(2, target_classes.unsqueeze(-1), 1) # (dim, index, src tensor)
-
-        # (1, 300, 9)
-        target_classes_onehot = target_classes_onehot[:,:,:-1]
+        # idx stores batch indx and query index; a no-object label writes 0 instead of a one
+        # (no boolean-mask indexing, which would sync with the host)
+        valid = target_classes_o < src_logits.shape[2]
+        target_classes_onehot[idx[0], idx[1], target_classes_o.clamp(max=src_logits.shape[2] - 1)] = valid.to(src_logits.dtype)
 
         # import pdb; pdb.set_trace()
         loss_ce = sigmoid_focal_loss(src_logits, target_classes_onehot, num_boxes, alpha=self.focal_alpha, gamma=2) * src_logits.shape[1]
@@ -498,9 +559,9 @@ class SetCriterion(nn.Module):
         losses = {}
         losses['loss_bbox'] = loss_bbox.sum() / num_boxes
 
-        loss_giou = 1 - torch.diag(box_ops.generalized_box_iou(
+        loss_giou = 1 - box_ops.pairwise_generalized_box_iou(
             box_ops.box_cxcywh_to_xyxy(src_boxes),
-            box_ops.box_cxcywh_to_xyxy(target_boxes)))
+            box_ops.box_cxcywh_to_xyxy(target_boxes))
         losses['loss_giou'] = loss_giou.sum() / num_boxes
         return losses
 
@@ -534,10 +595,13 @@ class SetCriterion(nn.Module):
         return losses, 
 
     def loss_da(self, outputs, use_focal=False):
+        return self._loss_da_elementwise(outputs, use_focal).mean(dtype=torch.float)
+
+    def _loss_da_elementwise(self, outputs, use_focal=False):
+        """Unreduced domain classification loss, the first half of the batch is source (0) and the rest target (1)"""
         B = outputs.shape[0]
         assert B % 2 == 0
 
-        
         targets = torch.empty_like(outputs)
         targets[:B//2] = 0
         targets[B//2:] = 1
@@ -549,19 +613,50 @@ class SetCriterion(nn.Module):
             p_t = prob * targets + (1 - prob) * (1 - targets)
             loss = loss * ((1 - p_t) ** self.da_gamma)
 
-        return loss.mean()
+        return loss
+
+    def losses_da(self, da_output):
+        """Domain losses of all discriminator heads; query-level heads use the focal variant.
+        Two or more heads of the same kind are concatenated along dim 1 so the loss runs once per kind,
+        each head still gets the mean over its own outputs
+        """
+        losses = {}
+        for use_focal in (False, True):
+            heads = [(k, v) for k, v in da_output.items() if ('query' in k) == use_focal]
+            if not heads:
+                continue
+            if len(heads) == 1:
+                # nothing to batch, avoid copying the (possibly large, e.g. backbone) tensor
+                k, v = heads[0]
+                losses[f'loss_{k}'] = self.loss_da(v, use_focal)
+                continue
+            heads = [(k, v.flatten(1)) for k, v in heads]
+            loss = self._loss_da_elementwise(torch.cat([v for _, v in heads], dim=1), use_focal)
+            for (k, _), l in zip(heads, loss.split([v.shape[1] for _, v in heads], dim=1)):
+                losses[f'loss_{k}'] = l.mean(dtype=torch.float)
+        # keep the order of da_output
+        return {f'loss_{k}': losses[f'loss_{k}'] for k in da_output}
+
+    @staticmethod
+    def _permutation_idx(idx_list):
+        perm_idx = torch.cat(idx_list)
+        sizes = torch.as_tensor([len(idx) for idx in idx_list], device=perm_idx.device)
+        batch_idx = torch.repeat_interleave(torch.arange(len(idx_list), device=perm_idx.device), sizes,
+                                            output_size=len(perm_idx))
+        return batch_idx, perm_idx
 
     def _get_src_permutation_idx(self, indices):
         # permute predictions following indices
-        batch_idx = torch.cat([torch.full_like(src, i) for i, (src, _) in enumerate(indices)])
-        src_idx = torch.cat([src for (src, _) in indices])
-        return batch_idx, src_idx
+        # every loss computed from one matcher call gets the same indices list, so reuse the result
+        if self._src_idx_cache is None or self._src_idx_cache[0] is not indices:
+            self._src_idx_cache = (indices, self._permutation_idx([src for (src, _) in indices]))
+        return self._src_idx_cache[1]
 
     def _get_tgt_permutation_idx(self, indices):
         # permute targets following indices
-        batch_idx = torch.cat([torch.full_like(tgt, i) for i, (_, tgt) in enumerate(indices)])
-        tgt_idx = torch.cat([tgt for (_, tgt) in indices])
-        return batch_idx, tgt_idx
+        if self._tgt_idx_cache is None or self._tgt_idx_cache[0] is not indices:
+            self._tgt_idx_cache = (indices, self._permutation_idx([tgt for (_, tgt) in indices]))
+        return self._tgt_idx_cache[1]
 
     def get_loss(self, loss, outputs, targets, indices, num_boxes, **kwargs):
         loss_map = {
@@ -595,15 +690,21 @@ class SetCriterion(nn.Module):
         #     if len(t['labels'])==0:
         #         import pdb; pdb.set_trace()
 
+        # Compute the average number of target boxes accross all nodes, for normalization purposes.
+        # The all_reduce runs while the matcher does, and num_boxes stays a 0-dim tensor so that
+        # normalizing the losses does not sync with the host
+        num_boxes = sum(len(t["labels"]) for t in targets)
+        num_boxes = torch.as_tensor(num_boxes, dtype=torch.float, device=next(iter(outputs.values())).device)
+        work = None
+        if is_dist_avail_and_initialized():
+            work = torch.distributed.all_reduce(num_boxes, async_op=True)
+
         # Retrieve the matching between the outputs of the last layer and the targets
         indices = self.matcher(outputs_without_aux, targets)
 
-        # Compute the average number of target boxes accross all nodes, for normalization purposes
-        num_boxes = sum(len(t["labels"]) for t in targets)
-        num_boxes = torch.as_tensor([num_boxes], dtype=torch.float, device=next(iter(outputs.values())).device)
-        if is_dist_avail_and_initialized():
-            torch.distributed.all_reduce(num_boxes)
-        num_boxes = torch.clamp(num_boxes / get_world_size(), min=1).item()
+        if work is not None:
+            work.wait()
+        num_boxes = torch.clamp(num_boxes / get_world_size(), min=1)
 
         # Compute all the requested losses
         losses = {}
@@ -613,7 +714,9 @@ class SetCriterion(nn.Module):
 
         # In case of auxiliary losses, we repeat this process with the output of each intermediate layer.
         if 'aux_outputs' in outputs:
-            for i, aux_outputs in enumerate(outputs['aux_outputs']):
+            aux = outputs['aux_outputs']
+            for i in range(aux['pred_logits'].shape[0]):
+                aux_outputs = {'pred_logits': aux['pred_logits'][i], 'pred_boxes': aux['pred_boxes'][i]}
                 indices = self.matcher(aux_outputs, targets)
                 for loss in self.losses:
                     if loss == 'masks':
@@ -629,9 +732,8 @@ class SetCriterion(nn.Module):
 
         if 'enc_outputs' in outputs:
             enc_outputs = outputs['enc_outputs']
-            bin_targets = copy.deepcopy(targets)
-            for bt in bin_targets:
-                bt['labels'] = torch.zeros_like(bt['labels'])
+            # shallow copies: only 'labels' differs, the other target tensors are shared
+            bin_targets = [{**t, 'labels': torch.zeros_like(t['labels'])} for t in targets]
             indices = self.matcher(enc_outputs, bin_targets)
             for loss in self.losses:
                 if loss == 'masks':
@@ -646,8 +748,7 @@ class SetCriterion(nn.Module):
                 losses.update(l_dict)
 
         if 'da_output' in outputs:
-            for k, v in outputs['da_output'].items():
-                losses[f'loss_{k}'] = self.loss_da(v, use_focal='query' in k)
+            losses.update(self.losses_da(outputs['da_output']))
 
         # for debugging
         if self.return_indices:
@@ -656,9 +757,42 @@ class SetCriterion(nn.Module):
             return losses
 
 
+def _topk_and_scale(out_logits, out_bbox, target_sizes, k=100,
+                    box_cxcywh_to_xyxy_scaled=box_ops.box_cxcywh_to_xyxy_scaled):
+    """ Top-k (query, class) pairs of every image, with their scores, labels and absolute xyxy boxes """
+    # sigmoid is monotonic, so select on the logits and only squash the kept ones
+    topk_values, topk_indexes = torch.topk(out_logits.view(out_logits.shape[0], -1), k, dim=1)
+    scores = topk_values.sigmoid()
+    num_classes = out_logits.shape[2]
+    if num_classes == 1:
+        # single class: the flat index is the query index
+        topk_boxes = topk_indexes
+        labels = torch.zeros_like(topk_indexes)
+    else:
+        topk_boxes = torch.div(topk_indexes, num_classes, rounding_mode='floor')
+        labels = topk_indexes - topk_boxes * num_classes
+    # row pick of the kept queries in each image
+    batch_idx = torch.arange(out_bbox.shape[0], device=out_bbox.device)[:, None]
+    boxes = out_bbox[batch_idx, topk_boxes]
+
+    # to xyxy, and from relative [0, 1] to absolute [0, height] coordinates
+    # (only for the kept boxes; target_sizes is (h, w), the scale is (w, h))
+    boxes = box_cxcywh_to_xyxy_scaled(boxes, target_sizes.flip(1)[:, None, :])
+    return scores, labels, boxes
+
+
 class PostProcess(nn.Module):
     """ This module converts the model's output into the format expected by the coco api"""
 
+    def __init__(self, use_cuda_graph=False):
+        super().__init__()
+        # evaluation calls this with the same shapes over and over, so optionally (EVAL_CUDA_GRAPH)
+        # the kernels are captured once per input shape on GPU and replayed
+        self.use_cuda_graph = use_cuda_graph
+        self._graphs = {}
+        # replaced by a compiled version in build() with MODEL.COMPILE
+        self.box_cxcywh_to_xyxy_scaled = box_ops.box_cxcywh_to_xyxy_scaled
+
     @torch.no_grad()
     def forward(self, outputs, target_sizes):
         """ Perform the computation
@@ -678,27 +812,64 @@ class PostProcess(nn.Module):
         assert len(out_logits) == len(target_sizes)
         assert target_sizes.shape[1] == 2
 
-        prob = out_logits.sigmoid()
-        topk_values, topk_indexes = torch.topk(prob.view(out_logits.shape[0], -1), 100, dim=1)
-        scores = topk_values
-        topk_boxes = topk_indexes // out_logits.shape[2]
-        labels = topk_indexes % out_logits.shape[2]
-        boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
-        boxes = torch.gather(boxes, 1, topk_boxes.unsqueeze(-1).repeat(1,1,4))
-        
-        # and from relative [0, 1] to absolute [0, height] coordinates
-        img_h, img_w = target_sizes.unbind(1)
-        scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
-        boxes = boxes * scale_fct[:, None, :]
+        inputs = (out_logits, out_bbox, target_sizes)
+        if self.use_cuda_graph and all(t.is_cuda for t in inputs):
+            scores, labels, boxes = self._replay(*inputs)
+        else:
+            scores, labels, boxes = self._postprocess(*inputs)
 
         results = [{'scores': s, 'labels': l, 'boxes': b} for s, l, b in zip(scores, labels, boxes)]
 
         return results
 
+    def _postprocess(self, out_logits, out_bbox, target_sizes):
+        return _topk_and_scale(out_logits, out_bbox, target_sizes,
+                               box_cxcywh_to_xyxy_scaled=self.box_cxcywh_to_xyxy_scaled)
+
+    def _replay(self, *inputs):
+        key = tuple((t.shape, t.dtype, t.device) for t in inputs)
+        if key not in self._graphs:
+            self._graphs[key] = self._capture(*inputs)
+        entry = self._graphs[key]
+        if entry is None:
+            # capture failed for this shape, stay eager
+            return self._postprocess(*inputs)
+
+        graph, static_inputs, static_outputs = entry
+        for static_input, t in zip(static_inputs, inputs):
+            static_input.copy_(t)
+        graph.replay()
+        # the next replay overwrites the static outputs
+        return [t.clone() for t in static_outputs]
+
+    def _capture(self, *inputs):
+        static_inputs = [t.clone() for t in inputs]
+        device = static_inputs[0].device
+        try:
+            # warm up on a side stream first (lazy init, compilation) as required for capture
+            stream = torch.cuda.Stream(device=device)
+            stream.wait_stream(torch.cuda.current_stream(device))
+            with torch.cuda.stream(stream):
+                for _ in range(2):
+                    self._postprocess(*static_inputs)
+            torch.cuda.current_stream(device).wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                static_outputs = self._postprocess(*static_inputs)
+        except RuntimeError:
+            return None
+        return graph, static_inputs, static_outputs
+
 
 class PostProcess_for_target(nn.Module):
     """ This module converts the model's output into the format expected by the coco api"""
 
+    def __init__(self):
+        super().__init__()
+        # replaced by a compiled version in build() with MODEL.COMPILE
+        self.box_cxcywh_to_xyxy_scaled = box_ops.box_cxcywh_to_xyxy_scaled
+
     @torch.no_grad()
     def forward(self, outputs, target_sizes):
         """ Perform the computation
@@ -709,22 +880,11 @@ class PostProcess_for_target(nn.Module):
                           For visualization, this should be the image size after data augment, but before padding
         """
         out_bbox = outputs['boxes']
-
-        # assert len(out_logits) == len(target_sizes)
         assert target_sizes.shape[1] == 2
 
-        # prob = out_logits.sigmoid()
-        # topk_values, topk_indexes = torch.topk(prob.view(out_logits.shape[0], -1), 100, dim=1)
-        # scores = topk_values
-        # topk_boxes = topk_indexes // out_logits.shape[2]
-        # labels = topk_indexes % out_logits.shape[2]
-        boxes = box_ops.box_cxcywh_to_xyxy(out_bbox)
-        # boxes = torch.gather(boxes, 1, topk_boxes.unsqueeze(-1).repeat(1,1,4))
-
-        # and from relative [0, 1] to absolute [0, height] coordinates
-        img_h, img_w = target_sizes.unbind(1)
-        scale_fct = torch.stack([img_w, img_h, img_w, img_h], dim=1)
-        boxes = boxes * scale_fct[:, None, :]
+        # ground truth boxes have no scores to rank, so there is no top-k / gather step,
+        # only the conversion to xyxy and from relative [0, 1] to absolute [0, height] coordinates
+        boxes = self.box_cxcywh_to_xyxy_scaled(out_bbox, target_sizes.flip(1)[:, None, :])
 
         results = [{'boxes': b} for b in boxes]
 
@@ -747,6 +907,32 @@ class MLP(nn.Module):
             x = F.relu(layer(x)) if i < self.num_layers - 1 else layer(x)
         return x
 
+@lru_cache(maxsize=4)
+def _build_aux_weight_items(weight_items, dec_layers):
+    # loss weights of the intermediate decoder layers ('_0', '_1', ...) and of the two-stage encoder ('_enc'),
+    # returned as a tuple of items so the cached value can not be mutated
+    aux_weight_dict = {}
+    for i in range(dec_layers - 1):
+        aux_weight_dict.update({k + f'_{i}': v for k, v in weight_items})
+    aux_weight_dict.update({k + f'_enc': v for k, v in weight_items})
+    return tuple(aux_weight_dict.items())
+
+
+def _compile(model, postprocessors):
+    """ torch.compile the small, frequently called pieces (MODEL.COMPILE): the extra feature levels,
+        the MLP heads and discriminators, and the box conversion of the post-processors
+    """
+    # image sizes change from batch to batch (random resize), and with them the feature map and
+    # token counts, so trace with dynamic shapes rather than specializing on every shape
+    model._extend_levels = torch.compile(model._extend_levels, dynamic=True)
+    for module in model.modules():
+        if isinstance(module, MLP):
+            module.forward = torch.compile(module.forward, dynamic=True)
+    for postprocessor in postprocessors:
+        postprocessor.box_cxcywh_to_xyxy_scaled = torch.compile(postprocessor.box_cxcywh_to_xyxy_scaled,
+                                                                dynamic=True)
+
+
 # where the whole deformable transformer and backbone are initialised
 def build(cfg):
     device = torch.device(cfg.DEVICE)
@@ -785,11 +971,7 @@ def build(cfg):
         weight_dict["loss_dice"] = cfg.LOSS.DICE_LOSS_COEF
     # TODO this is a hack
     if cfg.LOSS.AUX_LOSS:
-        aux_weight_dict = {}
-        for i in range(cfg.MODEL.DEC_LAYERS - 1):
-            aux_weight_dict.update({k + f'_{i}': v for k, v in weight_dict.items()})
-        aux_weight_dict.update({k + f'_enc': v for k, v in weight_dict.items()})
-        weight_dict.update(aux_weight_dict)
+        weight_dict.update(_build_aux_weight_items(tuple(weight_dict.items()), cfg.MODEL.DEC_LAYERS))
 
     weight_dict['loss_backbone'] = cfg.LOSS.BACKBONE_LOSS_COEF
     weight_dict['loss_space_query'] = cfg.LOSS.SPACE_QUERY_LOSS_COEF
@@ -809,8 +991,12 @@ def build(cfg):
         criterion = SetCriterion(cfg.DATASET.NUM_CLASSES, matcher, weight_dict, losses, focal_alpha=cfg.LOSS.FOCAL_ALPHA, da_gamma=cfg.LOSS.DA_GAMMA, return_indices=False)
     
     criterion.to(device)
-    postprocessors = {'bbox': PostProcess()}
+    postprocessors = {'bbox': PostProcess(use_cuda_graph=cfg.EVAL_CUDA_GRAPH)}
     postprocessors_target = {'bbox': PostProcess_for_target()}
+    if cfg.MODEL.COMPILE:
+        # the compiled pieces belong to DeformableDETR, also when it is wrapped by DETRsegm
+        detr = model.detr if cfg.MODEL.MASKS else model
+        _compile(detr, [postprocessors['bbox'], postprocessors_target['bbox']])
     if cfg.MODEL.MASKS:
         postprocessors['segm'] = PostProcessSegm()
         if cfg.DATASET.DATASET_FILE == "coco_panoptic":
@@ -51,7 +51,8 @@ at::Tensor ms_deform_attn_cuda_forward(
 
     AT_ASSERTM(batch % im2col_step_ == 0, "batch(%d) must divide im2col_step(%d)", batch, im2col_step_);
     
-    auto output = at::zeros({batch, num_query, num_heads, channels}, value.options());
+    // every element is written exactly once by ms_deformable_im2col_gpu_kernel, so no zero-fill is needed
+    auto output = at::empty({batch, num_query, num_heads, channels}, value.options());
 
     const int batch_n = im2col_step_;
     auto output_n = output.view({batch/im2col_step_, batch_n, num_query, num_heads, channels});
@@ -57,9 +57,9 @@ class DETRsegm(nn.Module):
         outputs_coord = self.detr.bbox_embed(hs).sigmoid()
         out = {"pred_logits": outputs_class[-1], "pred_boxes": outputs_coord[-1]}
         if self.detr.aux_loss:
-            out["aux_outputs"] = [
-                {"pred_logits": a, "pred_boxes": b} for a, b in zip(outputs_class[:-1], outputs_coord[:-1])
-            ]
+            # the wrapped model decides the layout its criterion expects
+            # (deformable_detr stacks the intermediate layers in one dict)
+            out["aux_outputs"] = self.detr._set_aux_loss(outputs_class, outputs_coord)
 
         # FIXME h_boxes takes the last one computed, keep this in mind
         bbox_mask = self.bbox_attention(hs[-1], memory, mask=mask)
@@ -223,7 +223,8 @@ def sigmoid_focal_loss(inputs, targets, num_boxes, alpha: float = 0.25, gamma: f
         alpha_t = alpha * targets + (1 - alpha) * (1 - targets)
         loss = alpha_t * loss
 
-    return loss.mean(1).sum() / num_boxes
+    # reduce in fp32 even when the elementwise part ran in half precision
+    return loss.mean(1, dtype=torch.float).sum() / num_boxes
 
 
 class PostProcessSegm(nn.Module):